@@ -0,0 +1,176 @@
+# This file runs the ffmpeg processes of the bot: it limits how many run at once, lowers their priority,
+# applies resource limits, kills the hung ones and accounts their CPU and memory use per guild
+
+from init import log, setup_traceback  # For debugging purposes
+from init import FFMPEG_MAX_CONCURRENT, FFMPEG_NICENESS, FFMPEG_CPU_LIMIT, FFMPEG_MEMORY_LIMIT, FFMPEG_STALL_TIMEOUT
+
+import asyncio
+import shutil  # To find the nice and prlimit tools
+from pathlib import Path
+
+try:
+    import resource  # For CPU accounting of finished processes (not available on Windows)
+except ImportError:
+    resource = None
+
+try:
+    import psutil  # Optional, for CPU and memory accounting of the processes
+except ImportError:
+    psutil = None
+
+# Setup beautiful traceback provided by rich library
+setup_traceback()
+
+
+# Resource usage of the ffmpeg processes of one guild
+class GuildUsage:
+    def __init__(self):
+        self.processes: int = 0  # Number of processes started
+        self.running: int = 0  # Number of processes running right now
+        self.killed: int = 0  # Number of processes killed because they hung
+        self.cpu_time: float = 0  # CPU seconds used by all processes (sampled while running, exact once finished)
+        self.peak_rss: int = 0  # Highest memory use of a single process in bytes (sampled)
+
+
+class FfmpegSupervisor:
+    sample_interval: float = 1  # Seconds between checks of a running process
+
+    def __init__(self, max_concurrent: int, niceness: int, cpu_limit: int, memory_limit: int, stall_timeout: float):
+        self.niceness = niceness  # Added to the priority of every process (higher is lower priority)
+        self.cpu_limit = cpu_limit  # CPU seconds a process may use, 0 for no limit
+        self.memory_limit = memory_limit  # Address space of a process in bytes, 0 for no limit
+        self.stall_timeout = stall_timeout  # A process which doesn't write any output for this long is killed
+
+        self.__slots = asyncio.Semaphore(max_concurrent)  # Caps the number of processes running at once
+        self.usage: dict[int, GuildUsage] = {}  # { guild_id: usage }
+
+        # Command which runs ffmpeg with the priority and limits applied (ffmpeg never runs without them)
+        self.__command: list[str] = self.__get_command()
+
+        # CPU seconds of all finished child processes when last checked (the final figures are taken from it)
+        self.__children_cpu: float | None = FfmpegSupervisor.__get_children_cpu()
+
+        if psutil is None:
+            log.warn('psutil is not installed, ffmpeg memory use and CPU use of running processes will not be tracked')
+
+    # Run ffmpeg with the arguments for the guild, output is the file ffmpeg writes (used to detect hangs)
+    # Returns the exit code and stderr of the process
+    async def run(self, args: list[str], guild_id: int, output: Path) -> tuple[int, bytes]:
+        usage = self.usage.setdefault(guild_id, GuildUsage())
+
+        if self.__slots.locked():
+            log.info('Waiting for a free ffmpeg slot...')
+
+        async with self.__slots:
+            process = await asyncio.create_subprocess_exec(
+                *self.__command, *args, stdin=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+
+            usage.processes += 1
+            usage.running += 1
+            sampled = GuildUsage()  # CPU time of this process sampled while it's running
+            watchdog = asyncio.create_task(self.__watch(process, output, usage, sampled))
+
+            try:
+                _, stderr = await process.communicate()
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+            finally:
+                watchdog.cancel()
+                usage.running -= 1
+                self.__account(usage, sampled)
+
+        return process.returncode, stderr
+
+    """
+    Prefix ffmpeg with nice and prlimit, they apply the priority and limits and then exec ffmpeg in the same process.
+    (preexec_fn would do the same without the tools, but it may deadlock the child while other threads are running,
+    and the resolver and download threads are)
+    """
+    def __get_command(self) -> list[str]:
+        command = ['ffmpeg']
+
+        limits = []
+        if self.cpu_limit:
+            limits.append(f'--cpu={self.cpu_limit}')
+        if self.memory_limit:
+            limits.append(f'--as={self.memory_limit}')
+        if limits:
+            if shutil.which('prlimit'):
+                command = ['prlimit', *limits, *command]
+            else:
+                log.warn('prlimit is not installed, ffmpeg CPU and memory limits will not be applied')
+
+        if self.niceness:
+            if shutil.which('nice'):
+                command = ['nice', '-n', str(self.niceness), *command]
+            else:
+                log.warn('nice is not installed, ffmpeg priority will not be lowered')
+
+        return command
+
+    # Replace the sampled CPU time of a finished process with the exact one
+    def __account(self, usage: GuildUsage, sampled: GuildUsage):
+        children_cpu = FfmpegSupervisor.__get_children_cpu()
+        if children_cpu is None:  # Not available on Windows, keep the sampled figure
+            return
+
+        # Processes are reaped one by one and accounted right after, so the difference belongs to this one
+        # (if two processes finish at the same moment, the first one accounted gets both)
+        usage.cpu_time += children_cpu - self.__children_cpu - sampled.cpu_time
+        self.__children_cpu = children_cpu
+
+    # CPU seconds used by all finished (reaped) child processes, None if it's not available
+    @staticmethod
+    def __get_children_cpu() -> float | None:
+        if resource is None:
+            return None
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return children.ru_utime + children.ru_stime
+
+    # Sample the resource use of the process and kill it if it stops writing output
+    async def __watch(self, process: asyncio.subprocess.Process, output: Path, usage: GuildUsage,
+                      sampled: GuildUsage):
+        ps = None
+        last_size, stalled = -1, 0.0
+
+        while process.returncode is None:
+            await asyncio.sleep(FfmpegSupervisor.sample_interval)
+
+            if psutil is not None:
+                try:
+                    # Created here, as the process may finish before the first sample
+                    ps = ps or psutil.Process(process.pid)
+                    times = ps.cpu_times()
+                    usage.cpu_time += times.user + times.system - sampled.cpu_time
+                    sampled.cpu_time = times.user + times.system
+                    usage.peak_rss = max(usage.peak_rss, ps.memory_info().rss)
+                except psutil.Error:  # The process has just finished or can't be read, skip this sample
+                    pass
+
+            size = output.stat().st_size if output.exists() else 0
+            stalled = stalled + FfmpegSupervisor.sample_interval if size == last_size else 0
+            last_size = size
+
+            if stalled >= self.stall_timeout:
+                log.error(f'ffmpeg process pid={process.pid} wrote nothing for {stalled:.0f}s, killing it')
+                usage.killed += 1
+                process.kill()
+                break
+
+    # Total usage of all guilds
+    def get_total_usage(self) -> GuildUsage:
+        total = GuildUsage()
+        for usage in self.usage.values():
+            total.processes += usage.processes
+            total.running += usage.running
+            total.killed += usage.killed
+            total.cpu_time += usage.cpu_time
+            total.peak_rss = max(total.peak_rss, usage.peak_rss)
+        return total
+
+
+supervisor = FfmpegSupervisor(max_concurrent=FFMPEG_MAX_CONCURRENT, niceness=FFMPEG_NICENESS,
+                              cpu_limit=FFMPEG_CPU_LIMIT, memory_limit=FFMPEG_MEMORY_LIMIT,
+                              stall_timeout=FFMPEG_STALL_TIMEOUT)
@@ -14,6 +14,22 @@ GUILD_IDS = config['guild_ids']
 DESCRIPTION = config['description']
 HELP_MESSAGE = config['help_message']
 OUTPUT_PATH = config['output_path']
+OPUS_STORE_PATH = config['opus_store_path']
+OPUS_BITRATE = config['opus_bitrate']  # In kbps
+OPUS_STORE_MAX_SIZE = config['opus_store_max_mb'] * 1024 * 1024  # In bytes
+STREAM_POLICY = config['stream_policy']  # 'quality', 'match' or 'economy' (see youtube_handler.StreamPolicy)
+PREFERRED_AUDIO_CODECS = config['preferred_audio_codecs']
+KEEP_PARTIAL_DOWNLOADS = config['keep_partial_downloads']  # Resume cancelled downloads instead of restarting
+PARTIAL_DOWNLOAD_MAX_AGE = config['partial_download_max_age_hours'] * 3600  # In seconds
+STREAM_URL_EXPIRY_MARGIN = config['stream_url_expiry_margin']  # Seconds before expiry when cached URLs are dropped
+MAX_MUSIC_PLAYERS = config['max_music_players']  # Maximum number of music player messages kept up to date
+INTERACTION_TOKEN_LIFETIME = config['interaction_token_lifetime']  # In seconds, Discord's limit is 15 minutes
+TRACE_PATH = config['trace_path']  # Where interactions are recorded for replay.py, empty to disable recording
+FFMPEG_MAX_CONCURRENT = config['ffmpeg_max_concurrent']  # Maximum number of ffmpeg processes running at once
+FFMPEG_NICENESS = config['ffmpeg_niceness']  # Added to the priority of ffmpeg processes (higher is lower priority)
+FFMPEG_CPU_LIMIT = config['ffmpeg_cpu_limit']  # CPU seconds per ffmpeg process, 0 for no limit
+FFMPEG_MEMORY_LIMIT = config['ffmpeg_memory_limit_mb'] * 1024 * 1024  # In bytes, 0 for no limit
+FFMPEG_STALL_TIMEOUT = config['ffmpeg_stall_timeout']  # Seconds without output after which ffmpeg is killed
 LOGO_PATH = config['logo']
 
 # Set up logger
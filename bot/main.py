@@ -7,6 +7,9 @@ PyNaCl library should also be installed
 import discord  # py-cord - Python Discord Library
 from init import TOKEN, GUILD_IDS, HELP_MESSAGE, DESCRIPTION, log, setup_traceback  # Get configuration
 from music_handler import MusicHandler  # For handling music
+from player_registry import PlayerRegistry  # For tracking music player messages
+from trace_recorder import recorder  # For recording interaction traces (if enabled)
+from ffmpeg_supervisor import supervisor, GuildUsage  # For ffmpeg resource usage
 from youtube_handler import Search  # For searching music
 from itertools import islice  # To slice YouTube search results
 
@@ -33,6 +36,36 @@ async def on_disconnect():
     pass
 
 
+# The listeners below record the interaction load, see trace_recorder.py and replay.py
+
+# Get id of the voice channel the member is in (or None)
+def get_voice_channel_id(member: discord.Member | discord.User) -> int | None:
+    voice = getattr(member, 'voice', None)
+    return voice.channel.id if voice and voice.channel else None
+
+
+@bot.listen('on_application_command')
+async def record_command(ctx: discord.ApplicationContext):
+    recorder.begin(ctx.interaction.id)
+    recorder.record('command', ctx.command.qualified_name, guild=ctx.guild_id, channel=ctx.channel_id,
+                    voice=get_voice_channel_id(ctx.author),
+                    options={o['name']: o['value'] for o in ctx.selected_options or []})
+
+
+@bot.listen('on_application_command_completion')
+async def record_command_completion(ctx: discord.ApplicationContext):
+    recorder.finish(ctx.interaction.id, 'done', ctx.command.qualified_name, guild=ctx.guild_id)
+
+
+@bot.listen('on_voice_state_update')
+async def record_voice_state(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    if before.channel == after.channel:  # Mute, deafen, etc.
+        return
+    name = 'join' if before.channel is None else 'leave' if after.channel is None else 'move'
+    recorder.record('voice', name, guild=member.guild.id, member=member.id,
+                    voice=after.channel.id if after.channel else None)
+
+
 # This class is the control buttons (play/pause, mute/unmute) View
 class MusicPlayerView(discord.ui.View):
     # By how much percent will the volume increase/decrease when the buttons are clicked
@@ -44,6 +77,14 @@ class MusicPlayerView(discord.ui.View):
     def __init__(self):
         super().__init__(timeout=None)  # So that the buttons never timeout
 
+    # Called before every button callback, used to record the clicks
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        button = next((item for item in self.children if getattr(item, 'custom_id', None) == interaction.custom_id),
+                      None)
+        recorder.record('button', button.label if button else interaction.custom_id, guild=interaction.guild_id,
+                        channel=interaction.channel_id, voice=get_voice_channel_id(interaction.user))
+        return True
+
     # This function turns plain string into an embed to display in messages
     @staticmethod
     def get_embed(text: str) -> discord.Embed:
@@ -151,15 +192,18 @@ class VideoSelectView(discord.ui.View):
         options = [discord.SelectOption(label=video[0],
                                         description=f'{video[1]}, {music_handler.readable_view_count(video[2])} views',
                                         value=video[3]) for video in videos]
-        self.select = discord.ui.Select(placeholder="Select a video to play...",
-                                        min_values=1, max_values=1, options=options)
+        # Several videos can be selected, they are all added to the queue at once
+        self.select = discord.ui.Select(placeholder="Select videos to play...",
+                                        min_values=1, max_values=min(len(options), 25), options=options)
         self.select.callback = self.select_callback
         self.add_item(self.select)
 
     async def select_callback(self, interaction: discord.Interaction):
-        for link in self.select.values:
-            ctx = discord.ApplicationContext(bot=bot, interaction=interaction)
-            await queue(ctx, link)
+        recorder.record('select', 'search', guild=interaction.guild_id, channel=interaction.channel_id,
+                        voice=get_voice_channel_id(interaction.user), values=self.select.values)
+
+        ctx = discord.ApplicationContext(bot=bot, interaction=interaction)
+        await queue(ctx, '\n'.join(self.select.values))
 
 
 # Number of results in autocomplete (in /play, /queue)
@@ -202,12 +246,12 @@ async def play(ctx: discord.ApplicationContext,
         await ctx.followup.send(embed=MusicPlayerView.get_embed('Your music will start playing shortly'))
 
     # Request the music
-    return await music_handler.request_music(ctx=ctx, query=query, add_to_queue=False)
+    return await music_handler.request_music(ctx=ctx, queries=MusicHandler.split_queries(query), add_to_queue=False)
 
 
-@bot.slash_command(guild_ids=GUILD_IDS, description='Add a song to the queue.')
+@bot.slash_command(guild_ids=GUILD_IDS, description='Add songs to the queue.')
 async def queue(ctx: discord.ApplicationContext,
-                query: discord.Option(str, description='Search phrase or YouTube link',
+                query: discord.Option(str, description='Search phrases or YouTube links (separate several with ;)',
                                       autocomplete=play_autocomplete)):
     # defer the response so that it doesn't timeout
     await ctx.response.defer()
@@ -228,7 +272,7 @@ async def queue(ctx: discord.ApplicationContext,
         await ctx.followup.send(embed=MusicPlayerView.get_embed('Added your music to the queue'))
 
     # Request the music
-    return await music_handler.request_music(ctx=ctx, query=query, add_to_queue=True)
+    return await music_handler.request_music(ctx=ctx, queries=MusicHandler.split_queries(query), add_to_queue=True)
 
 
 # Search and get detailed list of videos
@@ -238,7 +282,8 @@ async def search(ctx: discord.ApplicationContext, query: discord.Option(str, des
     await ctx.response.defer()
 
     # Get detailed result (title, view, author, url) from YouTube
-    videos = Search.get_all_details(query)
+    with recorder.timed('resolve', 'search', key=query):
+        videos = Search.get_all_details(query)
 
     view = VideoSelectView(videos)
     await ctx.followup.send(view=view)
@@ -304,6 +349,35 @@ async def volume(ctx: discord.ApplicationContext, vol: discord.Option(int, descr
         await music_handler.update_state()
 
 
+@bot.slash_command(guild_ids=GUILD_IDS, description='Move to a moment of the current song')
+async def seek(ctx: discord.ApplicationContext, position: discord.Option(str, description='Time, for example 1:30')):
+    seconds = MusicHandler.parse_time(position)
+    if not music_handler.is_seekable():
+        await ctx.respond(embed=MusicPlayerView.get_embed('There is no music to seek!'))
+    elif not await music_handler.check_valid_interaction(ctx):
+        return
+    elif seconds is None:
+        await ctx.respond(embed=MusicPlayerView.get_embed('Please enter a valid time (for example 1:30)'))
+    else:
+        await ctx.respond(embed=MusicPlayerView.get_embed(f'Moved to {position.strip()}'))
+        music_handler.request_seek(seconds)
+        await music_handler.update_state()
+
+
+@bot.slash_command(guild_ids=GUILD_IDS, description='Rewind the current song by n seconds')
+async def rewind(ctx: discord.ApplicationContext, n: discord.Option(int, description='in seconds', default=10)):
+    if not music_handler.is_seekable():
+        await ctx.respond(embed=MusicPlayerView.get_embed('There is no music to rewind!'))
+    elif not await music_handler.check_valid_interaction(ctx):
+        return
+    elif n <= 0:
+        await ctx.respond(embed=MusicPlayerView.get_embed('Please enter a positive number of seconds'))
+    else:
+        await ctx.respond(embed=MusicPlayerView.get_embed(f'Rewound by {n} seconds'))
+        music_handler.request_seek(max(0, music_handler.get_progress() - n))
+        await music_handler.update_state()
+
+
 # Autocomplete for jumping/removing from queue
 async def jump_remove_autocomplete(_: discord.AutocompleteContext) -> list[discord.OptionChoice]:
     return [discord.OptionChoice(name=f'{idx + 1}) {vid[2].youtube.title}',
@@ -350,13 +424,15 @@ async def remove(ctx: discord.ApplicationContext, n: discord.Option(int, descrip
 # (removes previous players)
 @bot.slash_command(guild_ids=GUILD_IDS, description='Display music controls')
 async def controls(ctx: discord.ApplicationContext):
-    # Remove previous music players from the updating list
-    for c in music_handler.music_player_contexts:
-        if c.channel == ctx.channel:
-            await c.delete()
+    # Add this music player to updating list, it replaces the previous music player of this channel
+    previous = music_handler.music_players.track(ctx, PlayerRegistry.Kind.CONTROLS)
 
-    # Add this music player to updating list
-    music_handler.music_player_contexts.append(ctx)
+    # Remove the previous music player
+    if previous is not None:
+        try:
+            await previous.delete()
+        except discord.HTTPException as e:  # It was already deleted, or its interaction token has expired
+            log.warn(f'Previous music player not removed, {e}')
 
     # Return the player
     await ctx.respond(view=MusicPlayerView(), embed=music_handler.get_queue_status())
@@ -365,10 +441,27 @@ async def controls(ctx: discord.ApplicationContext):
 # Get queue and song info without the buttons
 @bot.slash_command(guild_ids=GUILD_IDS)
 async def status(ctx: discord.ApplicationContext):
-    music_handler.music_player_contexts.append(ctx)
+    # Replaces the previous status message of this channel in the updating list
+    music_handler.music_players.track(ctx, PlayerRegistry.Kind.STATUS)
     await ctx.respond(embed=music_handler.get_queue_status())
 
 
+# Get the resource usage of ffmpeg processes per guild (for capacity planning)
+@bot.slash_command(guild_ids=GUILD_IDS, description='Display ffmpeg resource usage')
+async def resources(ctx: discord.ApplicationContext):
+    def format_usage(usage: GuildUsage) -> str:
+        return (f'**{usage.processes}** transcodes, **{usage.running}** running, **{usage.killed}** killed\n'
+                f'**{usage.cpu_time:.1f}s** CPU, **{usage.peak_rss // (1024 * 1024)}MB** peak memory')
+
+    embed = MusicPlayerView.get_embed('ffmpeg resource usage')
+    embed.add_field(name='This host', value=format_usage(supervisor.get_total_usage()), inline=False)
+    for guild_id, usage in supervisor.usage.items():
+        guild = bot.get_guild(guild_id)
+        embed.add_field(name=guild.name if guild else str(guild_id), value=format_usage(usage), inline=True)
+
+    await ctx.respond(embed=embed)
+
+
 @bot.slash_command(guild_ids=GUILD_IDS, description='Display the help message')
 async def help(ctx: discord.ApplicationContext):
     await ctx.respond(HELP_MESSAGE)
@@ -4,14 +4,20 @@
 import discord  # py-cord - Python Discord Library
 from discord.errors import NotFound  # Message not found error (for example)
 from init import log, setup_traceback  # For debugging purposes
-from youtube_handler import YoutubeObject  # For YouTube requests
+from youtube_handler import YoutubeObject, Download  # For YouTube requests
+from opus_store import OpusPacketStore, OpusPacketSource  # For storing and playing transcoded tracks
+from player_registry import PlayerRegistry  # For tracking music player messages
+from trace_recorder import recorder  # For recording resolver latencies (if enabled)
 
+import asyncio
 from asyncio import sleep
 import time  # For time tracking features
 
 from collections import deque  # For storing music
 from pathlib import Path
-from init import OUTPUT_PATH  # Where the music is downloaded
+from init import OUTPUT_PATH, KEEP_PARTIAL_DOWNLOADS  # Where the music is downloaded
+from init import OPUS_STORE_PATH, OPUS_BITRATE, OPUS_STORE_MAX_SIZE  # Packet store settings
+from init import MAX_MUSIC_PLAYERS, INTERACTION_TOKEN_LIFETIME  # Music player registry settings
 from enum import Enum  # For tracking music player state
 
 # Fixes pytube AgeRestrictionError bug when downloading non age-restricted videos
@@ -36,23 +42,29 @@ class MusicHandler:
         self.queue: deque[tuple[discord.ApplicationContext, int, YoutubeObject]] = deque()
 
         """
-        List that keeps contexts of all music players.
-        The purpose of this list is to let the bot update all the music player embeds
+        Registry that keeps contexts of all music players, at most one of each kind per channel.
+        The purpose of the registry is to let the bot update all the music player embeds
         in all channels when the song state (for example, volume) changes. 
         It's also used not to let bot send music player to the same channel twice (if not requested with /controls)
         see the slash commands /play and /queue for usage mentioned above
         """
-        self.music_player_contexts: list[discord.ApplicationContext] = []
+        self.music_players = PlayerRegistry(max_size=MAX_MUSIC_PLAYERS, token_lifetime=INTERACTION_TOKEN_LIFETIME)
 
         self.__is_active: bool = False  # Used check whether __music_task is running
         self.__request_skip: bool = False  # Skips current song (see __music_task) if set to True
 
-        self.__start_time: float = time.time()  # Used to track video progress
-        self.__pause_time: float | None = None  # Used to pause progress when pausing audio
-
         self.__volume: int = 1  # Keep current volume
         self.now_playing: YoutubeObject | None = None  # Store currently playing song
 
+        # Tracks transcoded once into Opus packets, replays are played from here without downloading or ffmpeg
+        self.packet_store = OpusPacketStore(OPUS_STORE_PATH, bitrate=OPUS_BITRATE, max_size=OPUS_STORE_MAX_SIZE)
+
+        # Downloads and transcodes the current song, cancelled when the song is skipped or the queue is cleared
+        self.__preparing: asyncio.Task | None = None
+
+        # (video_id, task) which prepares the next song in the queue while the current one is playing
+        self.__prefetch: tuple[str, asyncio.Task] | None = None
+
     # Loops and plays every song from the queue
     async def __music_task(self):
         self.__is_active = True
@@ -66,19 +78,27 @@ class MusicHandler:
                      f'id={channel_id}')
 
             self.now_playing = yt
+            video_id = yt.youtube.video_id
 
-            # Get the video stream
-            stream = yt.get_stream()
+            # Download and transcode the song (or take over the prefetch if it's already preparing this song)
+            self.__preparing = self.__take_prefetch(video_id) or asyncio.create_task(self.__prepare(yt, channel_id))
 
-            # Update current player state to DOWNLOADING
-            await self.update_state(MusicHandler.State.DOWNLOADING)
+            # Wait without letting the cancellation of the preparing task cancel this task as well
+            await asyncio.wait({self.__preparing})
+            preparing, self.__preparing = self.__preparing, None
 
-            log.info(f'Downloading the video...\n\t'
-                     f'from={yt.youtube.watch_url}\n\t'
-                     f'to={stream.default_filename}')
+            # Skipped or cleared while downloading, go to the next song
+            if preparing.cancelled():
+                log.info('Preparing the song was cancelled')
+                self.__request_skip = False
+                continue
 
-            # Download the audio
-            video_path = Path(stream.download(output_path=OUTPUT_PATH))
+            # Download or transcoding failed, tell the music players and go to the next song
+            if preparing.exception() is not None:
+                log.error(f'Preparing the song failed, {preparing.exception()!r}')
+                await self.notify(f'Sorry, I couldn\'t play {yt.youtube.title}, skipping to the next song')
+                self.__request_skip = False
+                continue
 
             # If the voice client does not exist or isn't connected to the channel, connect
             if self.vc is None or not self.vc.is_connected():
@@ -93,10 +113,9 @@ class MusicHandler:
                 await self.vc.move_to(self.bot.get_channel(channel_id))
                 await sleep(1)  # Wait for 1 second to ensure the voice client is connected
 
-            # Create the source from local file
-            log.info(f'Creating audio source from {video_path.resolve()} ...')
-            source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(str(video_path.resolve())),
-                                                  volume=self.__volume)
+            # Create the source from the packet store
+            log.info(f'Creating audio source from {self.packet_store.path_for(video_id).resolve()} ...')
+            source = self.packet_store.open(video_id, volume=self.__volume)
 
             # Update current player state to PLAYING
             await self.update_state(MusicHandler.State.PLAYING)
@@ -106,9 +125,6 @@ class MusicHandler:
             # Play the audio from source in the voice channel
             self.vc.play(source, after=lambda err: log.error(err) if err else None)
 
-            # Store playing start time
-            self.__start_time = time.time()
-
             # Loop which waits until the audio is over
             while self.vc.is_playing() or self.vc.is_paused():
                 # If a skip is requested, break immediately
@@ -117,6 +133,9 @@ class MusicHandler:
                     self.__request_skip = False
                     break
 
+                # Prepare the next song while this one is playing (the queue may change, so check every time)
+                self.__start_prefetch()
+
                 # Update current state (usually only the time updates)
                 await self.update_state()
                 await sleep(1)
@@ -126,19 +145,10 @@ class MusicHandler:
             # Stop playing
             self.vc.stop()
 
-            log.info(f'Removing the temporary file {video_path.resolve()} ...')
-
-            # Remove the locally saved audio file
-            try:
-                await sleep(1)  # Wait a bit before removing not to cause PermissionError
-                video_path.unlink()
-            except PermissionError:
-                log.warn(f'Temporary file not removed due to PermissionError')
+        self.__cancel_prefetch()
 
         self.now_playing = None
         self.__is_active = False
-        self.__start_time = time.time()
-        self.__pause_time = None
 
         # Update the status of all music players, set state to EMPTY (the queue is empty)
         await self.update_state(MusicHandler.State.EMPTY)
@@ -149,27 +159,134 @@ class MusicHandler:
 
             await self.vc.disconnect()
 
+    # Download the song and transcode it into the packet store (unless it was already played before)
+    async def __prepare(self, yt: YoutubeObject, channel_id: int):
+        video_id = yt.youtube.video_id
+
+        if self.packet_store.has(video_id):
+            log.info(f'Found the video in the packet store, id={video_id}')
+            return
+
+        # Get the video stream matching the bitrate of the packet store, there is no use in downloading more
+        # The stored song is replayed in every channel, so it doesn't depend on the channel it was requested in
+        with recorder.timed('resolve', 'stream', key=video_id):
+            stream = await asyncio.to_thread(yt.get_stream, self.packet_store.bitrate)
+
+        # Update current player state to DOWNLOADING (only if this isn't a prefetch of the next song)
+        if yt is self.now_playing:
+            await self.update_state(MusicHandler.State.DOWNLOADING)
+
+        # Named by video and stream, so that a partial download can be resumed
+        download = Download(stream, Path(OUTPUT_PATH) / f'{video_id}.{stream.itag}.{stream.subtype}',
+                            keep_partial=KEEP_PARTIAL_DOWNLOADS, refresh=lambda: yt.refresh_stream(stream.itag))
+
+        log.info(f'Downloading the video...\n\t'
+                 f'from={yt.youtube.watch_url}\n\t'
+                 f'to={download.path}')
+
+        # Download the audio
+        with recorder.timed('resolve', 'download', key=video_id):
+            video_path = await download.run()
+
+        # Update current player state to PROCESSING
+        if yt is self.now_playing:
+            await self.update_state(MusicHandler.State.PROCESSING)
+
+        # Transcode the audio into Opus packets (this is the only time ffmpeg runs for this song)
+        try:
+            with recorder.timed('resolve', 'transcode', key=video_id):
+                guild_id = self.bot.get_channel(channel_id).guild.id  # For resource accounting
+                await self.packet_store.transcode(video_path, video_id, guild_id=guild_id)
+
+        # Remove the downloaded file, the packet store has its own copy (or transcoding failed)
+        finally:
+            log.info(f'Removing the temporary file {video_path.resolve()} ...')
+
+            try:
+                video_path.unlink(missing_ok=True)
+            except PermissionError:
+                log.warn(f'Temporary file not removed due to PermissionError')
+
+    # Get the YouTube object of the query (runs in a thread)
+    @staticmethod
+    def __resolve(query: str) -> YoutubeObject:
+        with recorder.timed('resolve', 'query', key=query) as details:
+            youtube = YoutubeObject(query)
+
+            # The details let replay.py stand in for this video
+            if recorder.enabled and not youtube.error:
+                details.update(video_id=youtube.youtube.video_id, title=youtube.youtube.title,
+                               length=youtube.youtube.length)
+        return youtube
+
+    # Start preparing the first song in the queue, if it isn't prepared or being prepared already
+    def __start_prefetch(self):
+        if len(self.queue) == 0:
+            return
+
+        _, channel_id, yt = self.queue[0]
+        video_id = yt.youtube.video_id
+
+        if self.__prefetch is not None and self.__prefetch[0] == video_id:
+            return
+
+        # The queue has changed, the previous prefetch is not needed now
+        self.__cancel_prefetch()
+
+        if not self.packet_store.has(video_id):
+            log.info(f'Prefetching the next song, id={video_id}')
+            self.__prefetch = (video_id, asyncio.create_task(self.__prepare(yt, channel_id)))
+
+    # Get the prefetch task if it's preparing the given video, otherwise cancel it
+    def __take_prefetch(self, video_id: str) -> asyncio.Task | None:
+        if self.__prefetch is None or self.__prefetch[0] != video_id:
+            self.__cancel_prefetch()
+            return None
+
+        _, task = self.__prefetch
+        self.__prefetch = None
+        return task
+
+    def __cancel_prefetch(self):
+        if self.__prefetch is not None:
+            video_id, task = self.__prefetch
+            log.debug(f'Cancelling the prefetch, id={video_id}')
+            task.cancel()
+            self.__prefetch = None
+
     # Request play of a music
-    async def request_music(self, ctx: discord.ApplicationContext, query: str, add_to_queue: bool):
+    # (several songs can be requested at once, they keep their order in the queue)
+    async def request_music(self, ctx: discord.ApplicationContext, queries: list[str], add_to_queue: bool):
         log.debug('Music Handler request\n\t'
                   f'queue={add_to_queue}\n\t'
-                  f'query={query}')
+                  f'queries={queries}')
+
+        # Read before resolving, the requester may leave the voice channel while the queries are resolved
+        channel_id = ctx.author.voice.channel.id
+
+        # Get the YouTube objects, all of them are queried at the same time
+        videos = await asyncio.gather(*(asyncio.to_thread(MusicHandler.__resolve, query) for query in queries))
 
-        # Get the YouTube object
-        youtube = YoutubeObject(query)
+        errors = [youtube.error for youtube in videos if youtube.error]
+        if errors:
+            await ctx.respond('\n'.join(errors))
 
-        if youtube.error:
-            return await ctx.respond(youtube.error)
+        items = [(ctx, channel_id, youtube) for youtube in videos if not youtube.error]
+        if len(items) == 0:
+            return
 
-        log.info(f'Music request add_to_queue={add_to_queue}\nQueue size={len(self.queue)}')
+        log.info(f'Music request add_to_queue={add_to_queue}\nQueue size={len(self.queue)}\nSongs={len(items)}')
 
-        # If /queue is used, song will be added to the end of the queue
+        # If /queue is used, songs will be added to the end of the queue
         if add_to_queue:
-            self.queue.append((ctx, ctx.author.voice.channel.id, youtube))
+            self.queue.extend(items)
 
-        # if /play is used, song will be added to the beginning of the queue (and skip will be requested)
+        # if /play is used, songs will be added to the beginning of the queue (and skip will be requested)
         else:
-            self.queue.appendleft((ctx, ctx.author.voice.channel.id, youtube))
+            self.queue.extendleft(reversed(items))
+
+        # The command is done for the user now (it only returns when the queue is over, see __music_task)
+        recorder.finish(ctx.interaction.id, 'done', 'queue' if add_to_queue else 'play', guild=ctx.guild_id)
 
         # If __music_task is not active, call it
         if not self.__is_active:
@@ -181,39 +298,46 @@ class MusicHandler:
         elif not add_to_queue:
             self.request_skip()
 
+        # Show all the added songs in the music players with a single update
+        else:
+            await self.update_state()
+
     def request_skip(self):
         log.debug('Skip requested')
 
         # With self.__request_skip=True, playing loop in self.__music_task will terminate
         self.__request_skip = True
+
+        # If the song is still downloading, abort it immediately
+        if self.__preparing is not None:
+            self.__preparing.cancel()
         time.sleep(1)
 
     def request_pause(self):
         log.debug('Pause requested')
         self.vc.pause()
 
-        # Store the time of pause (for proper audio progress display)
-        self.__pause_time = time.time()
-
     def request_resume(self):
         log.debug('Resume requested')
         if self.vc.is_paused():
             self.vc.resume()
 
-            # Add the duration of pause to starting time for proper audio progress display
-            self.__start_time += time.time() - self.__pause_time
-
-            self.__pause_time = None
-
     def request_clear(self):
         log.debug('Clear requested')
 
-        # Clear the queue
+        # Clear the queue and abort the download of the next song
         self.queue.clear()
+        self.__cancel_prefetch()
 
         # Skip current song
         self.request_skip()
 
+    # Move the current song to the given position (in seconds), the stored packets make this instant
+    def request_seek(self, position: int):
+        log.debug(f'Seek requested from={self.get_progress()}s to={position}s')
+
+        self.vc.source.seek(position)
+
     def request_set_volume(self, vol: int):
         vol /= 100
 
@@ -243,12 +367,12 @@ class MusicHandler:
     """
     def get_music_player_from_context(self, ctx: discord.ApplicationContext) -> discord.ApplicationContext:
         # Get context of player in this channel (or None)
-        player_ctx = next((c for c in self.music_player_contexts if c.channel == ctx.channel), None)
+        player_ctx = self.music_players.get(ctx.channel.id, PlayerRegistry.Kind.CONTROLS)
 
         # If there isn't a music player in this context, add this context to music players
         # The music player will be sent from slash commands
         if player_ctx is None:
-            self.music_player_contexts.append(ctx)
+            self.music_players.track(ctx, PlayerRegistry.Kind.CONTROLS)
             return ctx
 
         # Else return the music player of this context
@@ -257,14 +381,28 @@ class MusicHandler:
 
     # Update the state of the music player
     async def update_state(self, state: State | None = None):
-        for ctx in self.music_player_contexts:
+        # The embed is the same for all music players, build it once
+        embed = self.get_queue_status(state=state)
+
+        for ctx in self.music_players:
             try:
-                await ctx.edit(embed=self.get_queue_status(state=state))
+                await ctx.edit(embed=embed)
 
             except NotFound:  # For example, the message was deleted
                 log.warn(f'Possible Music Player message/channel removal')
 
-                self.music_player_contexts.remove(ctx)
+                self.music_players.discard(ctx)
+
+    # Send a message to the channels of all music players (for example, about an error)
+    async def notify(self, text: str):
+        embed = discord.Embed(title=text, color=discord.Colour.light_gray())
+
+        # Sent as new messages to the channels, so it doesn't depend on the interaction tokens
+        for channel in {ctx.channel for ctx in self.music_players}:
+            try:
+                await channel.send(embed=embed)
+            except discord.HTTPException as e:
+                log.warn(f'Could not notify channel id={channel.id}, {e}')
 
     # Information functions
     def is_active(self) -> bool:
@@ -276,6 +414,17 @@ class MusicHandler:
     def get_queue_size(self) -> int:
         return len(self.queue)
 
+    # Whether the current song can be moved with request_seek
+    def is_seekable(self) -> bool:
+        return self.vc is not None and isinstance(self.vc.source, OpusPacketSource)
+
+    # Get the position in the current song in seconds
+    def get_progress(self) -> int:
+        # The source counts the packets which were actually played, so pauses and seeks are taken into account
+        if not self.is_seekable():
+            return 0
+        return int(self.vc.source.get_position())
+
     def get_voice_channel(self) -> discord.VoiceChannel | None:
         if not self.vc:
             return None
@@ -308,10 +457,7 @@ class MusicHandler:
 
         vol = f'{self.get_volume()}% volume' if self.__volume != 0 else 'muted'
 
-        if self.__pause_time:
-            spent_time = int(self.__pause_time - self.__start_time)
-        else:
-            spent_time = int(time.time() - self.__start_time)
+        spent_time = self.get_progress()
 
         if not self.now_playing:
             progress = ''
@@ -365,6 +511,22 @@ class MusicHandler:
         total_length = time.strftime(fm, gm)
         return f'{progress}/{total_length}'
 
+    # Parse time given by user (for example 90, 1:30 or 1:01:30) into seconds, None if it's not valid
+    @staticmethod
+    def parse_time(text: str) -> int | None:
+        parts = text.strip().split(':')
+        if len(parts) > 3 or not all(part.isdigit() for part in parts):
+            return None
+        seconds = 0
+        for part in parts:
+            seconds = seconds * 60 + int(part)
+        return seconds
+
+    # Split the text of /play or /queue into separate queries (separated by new lines or semicolons)
+    @staticmethod
+    def split_queries(text: str) -> list[str]:
+        return [query.strip() for query in text.replace(';', '\n').splitlines() if query.strip()]
+
     # Convert number (for example view count) to a human-readable format
     @staticmethod
     def readable_view_count(views: int) -> str:
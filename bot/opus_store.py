@@ -0,0 +1,196 @@
+# This file stores tracks as pre-transcoded 20 ms Opus packets, so that replaying a track
+# needs neither ffmpeg nor a decode - the packets are handed straight to the voice client
+
+import discord  # py-cord - Python Discord Library
+from discord.oggparse import OggStream  # To split ffmpeg's Ogg output into Opus packets
+from init import log, setup_traceback  # For debugging purposes
+from ffmpeg_supervisor import supervisor  # For running ffmpeg
+
+import array  # To apply volume to decoded audio (same as discord.PCMVolumeTransformer)
+import asyncio
+import mmap  # To read packets without loading the whole file
+import struct  # For the container header and index
+from pathlib import Path
+
+# Setup beautiful traceback provided by rich library
+setup_traceback()
+
+"""
+Layout of the packet container (all integers little-endian):
+    header: magic (4 bytes), version (1 byte), 3 padding bytes, packet count (uint32)
+    index:  packet count + 1 offsets (uint64), packet i spans [offset[i], offset[i + 1])
+    data:   the Opus packets, one per 20 ms frame
+"""
+MAGIC = b'FBOP'
+VERSION = 1
+HEADER = struct.Struct('<4sBxxxI')
+OFFSET = struct.Struct('<Q')
+SPAN = struct.Struct('<QQ')  # Two neighbouring offsets - start and end of one packet
+
+FRAME_LENGTH = 0.02  # Every packet is 20 ms of audio
+SILENCE = b'\x00' * discord.opus.Encoder.FRAME_SIZE  # 20 ms of silent PCM (for muted playback)
+
+
+# Audio source which reads Opus packets from a memory-mapped packet container
+class OpusPacketSource(discord.AudioSource):
+    def __init__(self, path: Path, volume: float = 1.0):
+        self.volume: float = volume  # Same attribute as discord.PCMVolumeTransformer, so it can be changed live
+
+        self.__file = open(path, 'rb')
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.packet_count = HEADER.unpack_from(self.__map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.cleanup()
+            raise ValueError(f'{path} is not a packet container (version {VERSION})')
+
+        self.__index: int = 0  # Number of the next packet to read
+        self.__decoder: discord.opus.Decoder | None = None  # Only created when the volume is changed
+
+        """
+        The voice client asks is_opus() once before playing (to create its encoder) and then after every read().
+        Returning False before the first read makes sure the encoder exists, so we can switch
+        between sending raw packets (volume 100%) and decoded, volume-adjusted audio at any moment
+        """
+        self.__passthrough: bool = False
+
+    def read(self) -> bytes:
+        if self.__index >= self.packet_count:
+            return b''
+
+        start, end = SPAN.unpack_from(self.__map, HEADER.size + self.__index * OFFSET.size)
+        self.__index += 1
+        packet = self.__map[start:end]
+
+        # Original volume, send the packet as it is
+        if self.volume == 1:
+            self.__passthrough = True
+            return packet
+
+        self.__passthrough = False
+
+        if self.volume == 0:
+            return SILENCE
+
+        if self.__decoder is None:
+            self.__decoder = discord.opus.Decoder()
+
+        # Scale the 16-bit samples and clamp them to their range
+        volume = min(self.volume, 2.0)
+        samples = array.array('h', self.__decoder.decode(packet))
+        for i in range(len(samples)):
+            samples[i] = int(min(0x7FFF, max(samples[i] * volume, -0x8000)))
+        return samples.tobytes()
+
+    def is_opus(self) -> bool:
+        return self.__passthrough
+
+    def cleanup(self):
+        self.__map.close()
+        self.__file.close()
+
+    # Current position in seconds
+    def get_position(self) -> float:
+        return self.__index * FRAME_LENGTH
+
+    def get_length(self) -> float:
+        return self.packet_count * FRAME_LENGTH
+
+    # Move to the given position in seconds (every packet has the same length, so this is O(1))
+    def seek(self, position: float):
+        self.__index = min(max(0, int(position / FRAME_LENGTH)), self.packet_count)
+
+
+# Directory of packet containers, named by YouTube video id
+class OpusPacketStore:
+    def __init__(self, directory: str | Path, bitrate: int, max_size: int):
+        self.directory = Path(directory)
+        self.bitrate = bitrate  # Opus bitrate in kbps
+        self.max_size = max_size  # In bytes, least recently played tracks are removed above it
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path_for(self, video_id: str) -> Path:
+        return self.directory / f'{video_id}.opk'
+
+    def has(self, video_id: str) -> bool:
+        return self.path_for(video_id).is_file()
+
+    # Open the stored track as an audio source
+    def open(self, video_id: str, volume: float = 1.0) -> OpusPacketSource:
+        path = self.path_for(video_id)
+        path.touch()  # Mark as recently played (see __evict)
+        return OpusPacketSource(path, volume=volume)
+
+    # Transcode an audio file to Opus with ffmpeg (once) and store its packets
+    # guild_id is the guild the song was requested in (for resource accounting)
+    async def transcode(self, source: Path, video_id: str, guild_id: int) -> Path:
+        path = self.path_for(video_id)
+        ogg_path = path.with_suffix('.ogg.tmp')
+
+        log.info(f'Transcoding {source.resolve()} ...\n\t'
+                 f'to={path.resolve()}\n\t'
+                 f'bitrate={self.bitrate}kbps')
+
+        try:
+            returncode, stderr = await supervisor.run([
+                '-nostdin', '-y', '-loglevel', 'error',
+                '-i', str(source.resolve()), '-vn', '-map_metadata', '-1',
+                '-c:a', 'libopus', '-b:a', f'{self.bitrate}k', '-ar', '48000', '-ac', '2',
+                '-frame_duration', '20', '-f', 'opus', str(ogg_path.resolve())], guild_id=guild_id, output=ogg_path)
+        except asyncio.CancelledError:
+            ogg_path.unlink(missing_ok=True)
+            raise
+
+        try:
+            if returncode != 0:
+                raise RuntimeError(f'ffmpeg exited with code {returncode}: {stderr.decode().strip()}')
+
+            # Packing is plain file work, keep it off the event loop
+            await asyncio.to_thread(OpusPacketStore.__pack, ogg_path, path)
+        finally:
+            ogg_path.unlink(missing_ok=True)
+
+        log.info(f'Transcoding finished, {path.stat().st_size // 1024}KB stored')
+
+        self.__evict(keep=path)
+        return path
+
+    # Write the packets of an Ogg Opus file into a packet container
+    @staticmethod
+    def __pack(ogg_path: Path, path: Path):
+        with open(ogg_path, 'rb') as ogg_file:
+            # Skip the OpusHead and OpusTags header packets, they are not audio
+            packets = [p for p in OggStream(ogg_file).iter_packets()
+                       if not p.startswith((b'OpusHead', b'OpusTags'))]
+
+        offset = HEADER.size + (len(packets) + 1) * OFFSET.size
+        offsets = [offset]
+        for packet in packets:
+            offset += len(packet)
+            offsets.append(offset)
+
+        # Write to a temporary file first, so a half-written container is never opened
+        tmp_path = path.with_suffix('.opk.tmp')
+        with open(tmp_path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(packets)))
+            file.write(struct.pack(f'<{len(offsets)}Q', *offsets))
+            for packet in packets:
+                file.write(packet)
+        tmp_path.replace(path)
+
+    # Remove least recently played tracks until the store fits into max_size
+    def __evict(self, keep: Path):
+        files = sorted((p for p in self.directory.glob('*.opk') if p != keep), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files) + keep.stat().st_size
+
+        for path in files:
+            if total <= self.max_size:
+                break
+            size = path.stat().st_size
+            try:
+                path.unlink()
+                total -= size
+                log.info(f'Removed {path.name} from the packet store')
+            except PermissionError:  # The track is probably playing right now
+                log.warn(f'{path.name} not removed from the packet store due to PermissionError')
@@ -0,0 +1,75 @@
+# This file keeps track of the music player messages, so that the bot can update them
+# all when the song state (for example, volume) changes
+
+import discord  # py-cord - Python Discord Library
+from init import log, setup_traceback  # For debugging purposes
+
+import time  # For interaction token expiry
+from collections import OrderedDict  # For keeping the entries in the order of tracking
+from enum import Enum  # For message kinds
+
+# Setup beautiful traceback provided by rich library
+setup_traceback()
+
+
+class PlayerRegistry:
+    # Kinds of tracked messages, every channel has at most one message of each kind
+    Kind = Enum('Kind', ['CONTROLS', 'STATUS'])
+
+    def __init__(self, max_size: int, token_lifetime: float):
+        self.max_size = max_size  # Maximum number of tracked messages across all channels
+
+        # Seconds after which a message is not tracked anymore
+        # (its interaction token expires and Discord rejects the edits)
+        self.token_lifetime = token_lifetime
+
+        """
+        { (channel_id, kind): (context, time of tracking) }
+        Ordered by the time of tracking, so the oldest entry is always the first one
+        and both expiry and eviction only look at the beginning
+        """
+        self.__entries: OrderedDict[tuple[int, PlayerRegistry.Kind], tuple[discord.ApplicationContext, float]] = \
+            OrderedDict()
+
+    # Get the tracked message of the given kind in the channel (or None)
+    def get(self, channel_id: int, kind: Kind) -> discord.ApplicationContext | None:
+        self.expire()
+        entry = self.__entries.get((channel_id, kind))
+        return entry[0] if entry else None
+
+    # Start tracking the message, returns the message of the same kind in the same channel it replaced (or None)
+    def track(self, ctx: discord.ApplicationContext, kind: Kind) -> discord.ApplicationContext | None:
+        # Expired messages must not be returned as replaced, their tokens can't be used anymore
+        self.expire()
+
+        key = (ctx.channel.id, kind)
+        replaced, _ = self.__entries.pop(key, (None, None))
+        self.__entries[key] = (ctx, time.monotonic())
+
+        # Stop tracking the oldest messages if there are too many
+        while len(self.__entries) > self.max_size:
+            (channel_id, old_kind), _ = self.__entries.popitem(last=False)
+            log.debug(f'Music player limit reached, not tracking {old_kind.name} in channel id={channel_id} anymore')
+
+        return replaced
+
+    # Stop tracking the message (for example, because it was deleted)
+    def discard(self, ctx: discord.ApplicationContext):
+        for key, (c, _) in list(self.__entries.items()):
+            if c is ctx:
+                del self.__entries[key]
+
+    # Stop tracking messages whose interaction tokens are about to expire
+    def expire(self):
+        deadline = time.monotonic() - self.token_lifetime
+        while self.__entries and next(iter(self.__entries.values()))[1] < deadline:
+            (channel_id, kind), _ = self.__entries.popitem(last=False)
+            log.debug(f'Interaction token expired for {kind.name} in channel id={channel_id}')
+
+    # Iterates over a snapshot of the tracked messages, so the registry can be changed while iterating
+    def __iter__(self):
+        self.expire()
+        return iter([ctx for ctx, _ in self.__entries.values()])
+
+    def __len__(self) -> int:
+        return len(self.__entries)
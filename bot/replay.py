@@ -0,0 +1,481 @@
+"""
+This file replays an interaction trace recorded by trace_recorder.py (set "trace_path" in config.json)
+against the music handler, with stand-ins for Discord and YouTube, and reports the observed latencies
+Usage: python replay.py trace.jsonl [--speed 10] [--api-latency 0.1]
+"""
+
+import argparse  # For command line arguments
+import asyncio
+import math
+import sys  # For the exit code
+import time  # For measuring latencies
+from pathlib import Path
+from statistics import median
+
+import music_handler  # The stand-ins replace its YouTube and packet store dependencies
+from init import log, setup_traceback  # For debugging purposes
+from music_handler import MusicHandler
+from player_registry import PlayerRegistry
+from trace_recorder import TraceRecorder, recorder
+
+# Setup beautiful traceback provided by rich library
+setup_traceback()
+
+
+# Stands in for the time module of music_handler, its blocking waits are scaled with the replay speed
+class ScaledTime:
+    def __init__(self, speed: float):
+        self.speed = speed
+
+    def sleep(self, seconds: float):
+        time.sleep(seconds / self.speed)
+
+    def __getattr__(self, name: str):
+        return getattr(time, name)
+
+
+# Stand-in for YouTube, every request takes as long as it took when it was recorded
+class YoutubeBackend:
+    def __init__(self, trace: list[dict], speed: float):
+        self.speed = speed
+
+        # { (name, key): [durations] } of recorded resolver events
+        self.latencies: dict[tuple[str, str], list[float]] = {}
+        self.videos: dict[str, dict] = {}  # { query: details of the video it resolved to }
+
+        for event in trace:
+            if event['kind'] != 'resolve':
+                continue
+            self.latencies.setdefault((event['name'], event['key']), []).append(event['duration'])
+            if event['name'] == 'query' and 'video_id' in event:
+                self.videos[event['key']] = event
+
+    # Recorded latency of the request (median of all requests of this kind if this one wasn't recorded)
+    def get_latency(self, name: str, key: str) -> float:
+        durations = self.latencies.get((name, key))
+        if durations is None:
+            durations = [d for (n, _), ds in self.latencies.items() if n == name for d in ds] or [0]
+        return median(durations) / self.speed
+
+    def get_video(self, query: str) -> 'Video':
+        details = self.videos.get(query, {})
+        return Video(video_id=details.get('video_id', f'replay{abs(hash(query)) % 10 ** 8}'),
+                     title=details.get('title', query), length=details.get('length', 180))
+
+    # Length of the video in seconds (3 minutes if it wasn't recorded)
+    def get_length(self, video_id: str) -> int:
+        return next((e.get('length', 180) for e in self.videos.values() if e['video_id'] == video_id), 180)
+
+
+class Video:
+    def __init__(self, video_id: str, title: str, length: int):
+        self.video_id = video_id
+        self.title = title
+        self.length = length
+        self.author = 'Replay'
+        self.views = 0
+        self.thumbnail_url = None
+        self.watch_url = f'https://youtube.com/watch?v={video_id}'
+
+
+class Stream:
+    def __init__(self, video_id: str):
+        self.video_id = video_id
+        self.itag = 251
+        self.subtype = 'webm'
+
+
+# Stands in for youtube_handler.YoutubeObject
+class YoutubeObject:
+    backend: YoutubeBackend
+
+    def __init__(self, query: str):
+        self.error: str | None = None
+        self.query = query
+        self.created = time.monotonic()
+        time.sleep(YoutubeObject.backend.get_latency('query', query))  # Resolved in a thread, like the real one
+        self.youtube = YoutubeObject.backend.get_video(query)
+
+    def get_stream(self, _: int) -> Stream:
+        time.sleep(YoutubeObject.backend.get_latency('stream', self.youtube.video_id))
+        return Stream(self.youtube.video_id)
+
+    def refresh_stream(self, _: int) -> Stream:
+        return self.get_stream(0)
+
+
+# Stands in for youtube_handler.Download
+class Download:
+    def __init__(self, stream: Stream, path: Path, keep_partial: bool, refresh=None):
+        self.stream = stream
+        self.path = path
+
+    async def run(self) -> Path:
+        await asyncio.sleep(YoutubeObject.backend.get_latency('download', self.stream.video_id))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.touch()  # The music handler removes it after transcoding
+        return self.path
+
+
+# Stands in for opus_store.OpusPacketSource, the position moves with the (accelerated) clock
+class Source:
+    def __init__(self, length: float, speed: float, volume: float):
+        self.length = length
+        self.speed = speed
+        self.volume = volume
+        self.__offset: float = 0  # Position when the clock was last started
+        self.__started: float | None = None  # Time when the clock was started, None if paused
+
+    def start(self):
+        self.__started = time.monotonic()
+
+    def pause(self):
+        self.__offset = self.get_position()
+        self.__started = None
+
+    def get_position(self) -> float:
+        if self.__started is None:
+            return self.__offset
+        return min(self.length, self.__offset + (time.monotonic() - self.__started) * self.speed)
+
+    def seek(self, position: float):
+        self.__offset = min(max(0.0, position), self.length)
+        if self.__started is not None:
+            self.__started = time.monotonic()
+
+    def is_finished(self) -> bool:
+        return self.get_position() >= self.length
+
+
+# Stands in for opus_store.OpusPacketStore
+class PacketStore:
+    def __init__(self, speed: float):
+        self.speed = speed
+        self.bitrate = music_handler.OPUS_BITRATE  # Used by the music handler to pick the YouTube stream
+        self.stored: dict[str, int] = {}  # { video_id: length }
+
+    def path_for(self, video_id: str) -> Path:
+        return Path(f'{video_id}.opk')
+
+    def has(self, video_id: str) -> bool:
+        return video_id in self.stored
+
+    def open(self, video_id: str, volume: float = 1.0) -> Source:
+        return Source(self.stored[video_id], self.speed, volume)
+
+    async def transcode(self, _: Path, video_id: str, guild_id: int):
+        await asyncio.sleep(YoutubeObject.backend.get_latency('transcode', video_id))
+        self.stored[video_id] = YoutubeObject.backend.get_length(video_id)
+
+
+# Stand-in for Discord, every API call takes api_latency seconds
+class Discord:
+    def __init__(self, api_latency: float):
+        self.api_latency = api_latency
+        self.channels: dict[int, Channel] = {}
+
+    async def call(self):
+        await asyncio.sleep(self.api_latency)
+
+    # Stands in for discord.Bot.get_channel
+    def get_channel(self, channel_id: int) -> 'Channel':
+        if channel_id not in self.channels:
+            self.channels[channel_id] = Channel(self, channel_id)
+        return self.channels[channel_id]
+
+
+class Channel:
+    def __init__(self, api: Discord, channel_id: int):
+        self.api = api
+        self.id = channel_id
+        self.name = f'channel-{channel_id}'
+        self.mention = f'<#{channel_id}>'
+        self.bitrate = 64000
+        self.guild = Guild()
+
+    async def send(self, **_):
+        await self.api.call()
+
+    async def connect(self) -> 'VoiceClient':
+        await self.api.call()
+        return VoiceClient(self)
+
+
+class Guild:
+    def __init__(self):
+        self.id = 0
+
+
+class Interaction:
+    def __init__(self):
+        self.id = id(self)
+
+
+class VoiceClient:
+    def __init__(self, channel: Channel):
+        self.channel = channel
+        self.source: Source | None = None
+        self.__connected: bool = True
+        self.__paused: bool = False
+
+    def is_connected(self) -> bool:
+        return self.__connected
+
+    def play(self, source: Source, after=None):
+        self.source = source
+        self.__paused = False
+        source.start()
+
+    def is_playing(self) -> bool:
+        return self.source is not None and not self.__paused and not self.source.is_finished()
+
+    def is_paused(self) -> bool:
+        return self.source is not None and self.__paused
+
+    def pause(self):
+        self.__paused = True
+        self.source.pause()
+
+    def resume(self):
+        self.__paused = False
+        self.source.start()
+
+    def stop(self):
+        self.source = None
+
+    async def move_to(self, channel: Channel):
+        await self.channel.api.call()
+        self.channel = channel
+
+    async def disconnect(self):
+        await self.channel.api.call()
+        self.__connected = False
+
+
+class Member:
+    def __init__(self, voice_channel: Channel | None):
+        self.voice = Voice(voice_channel) if voice_channel else None
+        self.mention = '@replay'
+
+
+class Voice:
+    def __init__(self, channel: Channel):
+        self.channel = channel
+
+
+class Followup:
+    def __init__(self, api: Discord):
+        self.api = api
+
+    async def send(self, **_):
+        await self.api.call()
+
+
+class Response:
+    def __init__(self, api: Discord):
+        self.api = api
+
+    async def defer(self):
+        await self.api.call()
+
+
+# Stands in for discord.ApplicationContext (and discord.Interaction of the buttons)
+class Context:
+    def __init__(self, api: Discord, event: dict):
+        self.api = api
+        self.channel = api.get_channel(event.get('channel') or 0)
+        self.author = Member(api.get_channel(event['voice']) if event.get('voice') else None)
+        self.user = self.author
+        self.guild_id = event.get('guild')
+        self.interaction = Interaction()
+        self.followup = Followup(api)
+        self.response = Response(api)
+
+    async def respond(self, *_, **__):
+        await self.api.call()
+
+    async def edit(self, **_):
+        await self.api.call()
+
+    async def delete(self):
+        await self.api.call()
+
+
+class Replay:
+    def __init__(self, trace: list[dict], speed: float, api_latency: float):
+        self.trace = trace
+        self.speed = speed
+        self.api = Discord(api_latency)
+
+        YoutubeObject.backend = YoutubeBackend(trace, speed)
+
+        # Don't record the replay into a trace
+        recorder.enabled = False
+
+        # MusicHandler's own waits (the update loop, request_skip) are accelerated as well
+        music_handler.sleep = lambda seconds: asyncio.sleep(seconds / speed)
+        music_handler.time = ScaledTime(speed)
+
+        # Swap the real YouTube, download and packet store dependencies for the stand-ins
+        music_handler.YoutubeObject = YoutubeObject
+        music_handler.Download = Download
+        music_handler.OpusPacketSource = Source
+        self.handler = MusicHandler(self.api)
+        self.handler.packet_store = PacketStore(speed)
+
+        # Measure preparing of every song (current and prefetched), failures are reported instead of hidden
+        prepare = self.handler._MusicHandler__prepare
+        self.handler._MusicHandler__prepare = lambda *args: self.measure('prepare', prepare(*args))
+
+        self.latencies: dict[str, list[float]] = {}  # { event name: [latencies] }
+        self.failures: int = 0  # Number of events and songs which failed
+        self.music_tasks: list[asyncio.Task] = []  # Tasks of request_music, they run the whole queue
+
+    async def run(self):
+        # Voice events don't reach the music handler (the bot doesn't listen to them), so they are not replayed
+        events = [e for e in self.trace if e['kind'] in ('command', 'button', 'select')]
+        voice_events = sum(1 for e in self.trace if e['kind'] == 'voice')
+        log.info(f'Replaying {len(events)} events at {self.speed}x speed, skipping {voice_events} voice events')
+
+        start = time.monotonic()
+        tasks = []
+        for event in events:
+            scheduled = start + event['t'] / self.speed
+            await asyncio.sleep(max(0.0, scheduled - time.monotonic()))
+            tasks.append(asyncio.create_task(self.dispatch(event, scheduled)))
+
+        await asyncio.gather(*tasks)
+
+        # Stop the music which is still playing
+        if self.handler.is_active():
+            self.handler.request_clear()
+        if self.music_tasks:
+            await asyncio.wait(self.music_tasks, timeout=5)
+
+    # Run one event and measure the time from when it was scheduled until it was handled
+    async def dispatch(self, event: dict, scheduled: float):
+        name = event['name'] if event['kind'] != 'button' else f'button:{event["name"]}'
+        try:
+            await self.measure(name, self.handle(event), scheduled)
+        except Exception:
+            pass  # Already reported by measure, the rest of the trace is still replayed
+
+    # Await the coroutine and record its latency under the name (with " (failed)" if it raised an exception)
+    # Cancelled coroutines (for example, skipped songs) are not recorded
+    async def measure(self, name: str, coroutine, start: float | None = None):
+        start = time.monotonic() if start is None else start
+        try:
+            result = await coroutine
+        except Exception as e:
+            log.error(f'Replaying {name} failed, {e!r}')
+            self.failures += 1
+            self.latencies.setdefault(f'{name} (failed)', []).append(time.monotonic() - start)
+            raise
+        self.latencies.setdefault(name, []).append(time.monotonic() - start)
+        return result
+
+    # Mirrors what main.py does for every event
+    async def handle(self, event: dict):
+        handler = self.handler
+        kind, name = event['kind'], event['name']
+
+        ctx = Context(self.api, event)
+        if kind == 'select':
+            return await self.request_music(ctx, '\n'.join(event['values']), add_to_queue=True)
+        if kind == 'button':
+            name = {'Stop': 'clear', 'Pause': 'pause', 'Resume': 'resume', 'Skip': 'skip',
+                    'Mute': 'mute', 'Unmute': 'unmute', 'Volume Up': 'volume up', 'Volume Down': 'volume down'}[name]
+
+        options = event.get('options', {})
+        active = handler.is_active()
+
+        match name:
+            case 'play' | 'queue':
+                return await self.request_music(ctx, options['query'], add_to_queue=name == 'queue')
+            case 'search':
+                await asyncio.sleep(YoutubeObject.backend.get_latency('search', options['query']))
+                return await ctx.respond()
+            case 'status' | 'controls':
+                handler.music_players.track(ctx, PlayerRegistry.Kind[name.upper()])
+                return await ctx.respond(embed=handler.get_queue_status())
+
+        # The rest of the events need music which is playing and a user in its voice channel
+        if not active or handler.vc is None or not await handler.check_valid_interaction(ctx):
+            return await ctx.respond()
+
+        match name:
+            case 'skip':
+                handler.request_skip()
+            case 'pause':
+                handler.request_pause()
+            case 'resume':
+                handler.request_resume()
+            case 'clear':
+                handler.request_clear()
+            case 'volume':
+                handler.request_set_volume(max(0, options['vol']))
+            case 'volume up':
+                handler.request_set_volume(handler.get_volume() + 25)
+            case 'volume down':
+                handler.request_set_volume(max(0, handler.get_volume() - 25))
+            case 'mute':
+                handler.request_set_volume(0)
+            case 'unmute':
+                handler.request_set_volume(100)
+            case 'jump' | 'remove':
+                if 0 < options['n'] <= handler.get_queue_size():
+                    (handler.request_jump if name == 'jump' else handler.request_remove)(options['n'] - 1)
+            case 'seek' | 'rewind':
+                if handler.is_seekable():
+                    position = MusicHandler.parse_time(options['position']) if name == 'seek' \
+                        else max(0, handler.get_progress() - options.get('n', 10))
+                    if position is not None:
+                        handler.request_seek(position)
+
+        await ctx.respond()
+        await handler.update_state()
+
+    # Request the music and wait until it's in the queue (request_music itself only returns when the queue is over)
+    async def request_music(self, ctx: Context, query: str, add_to_queue: bool):
+        self.handler.get_music_player_from_context(ctx)
+        await ctx.followup.send()
+
+        queries = MusicHandler.split_queries(query)
+        requested = time.monotonic()
+        task = asyncio.create_task(self.handler.request_music(ctx, queries, add_to_queue=add_to_queue))
+        self.music_tasks.append(task)
+
+        def is_queued(yt) -> bool:
+            return isinstance(yt, YoutubeObject) and yt.query in queries and yt.created >= requested
+
+        while not task.done() and not is_queued(self.handler.now_playing) \
+                and not any(is_queued(yt) for _, _, yt in self.handler.queue):
+            await asyncio.sleep(0.005)
+
+    def report(self):
+        print(f'{"event":<24}{"count":>7}{"p50":>10}{"p90":>10}{"p99":>10}{"max":>10}')
+        for name, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            p50, p90, p99 = (Replay.percentile(latencies, p) for p in (50, 90, 99))
+            print(f'{name:<24}{len(latencies):>7}{p50 * 1000:>8.0f}ms{p90 * 1000:>8.0f}ms'
+                  f'{p99 * 1000:>8.0f}ms{latencies[-1] * 1000:>8.0f}ms')
+        if self.failures:
+            print(f'{self.failures} events or songs failed, the latencies above are not representative')
+
+    # Nearest-rank percentile of sorted values
+    @staticmethod
+    def percentile(values: list[float], p: float) -> float:
+        return values[max(0, math.ceil(len(values) * p / 100) - 1)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded interaction trace and report latencies')
+    parser.add_argument('trace', help='Path to the trace recorded with "trace_path" in config.json')
+    parser.add_argument('--speed', type=float, default=1, help='Replay speed, for example 10 for 10x faster')
+    parser.add_argument('--api-latency', type=float, default=0.1, help='Latency of every Discord API call (s)')
+    args = parser.parse_args()
+
+    replay = Replay(TraceRecorder.load(args.trace), speed=args.speed, api_latency=args.api_latency)
+    asyncio.run(replay.run())
+    replay.report()
+    sys.exit(1 if replay.failures else 0)
@@ -0,0 +1,94 @@
+# This file records traces of the real interaction load (slash commands, buttons, voice events and
+# YouTube latencies), so that they can be replayed later with replay.py
+
+from init import log, setup_traceback  # For debugging purposes
+from init import TRACE_PATH  # Where the trace is recorded (empty to disable)
+
+import json  # Traces are stored as JSON lines
+import threading  # Events are also recorded from resolver threads
+import time  # For timestamps and durations
+from contextlib import contextmanager
+
+# Setup beautiful traceback provided by rich library
+setup_traceback()
+
+
+class TraceRecorder:
+    def __init__(self, path: str):
+        self.enabled: bool = bool(path)  # Recording is opt-in, an empty path disables it
+        self.path = path
+
+        self.__start: float = time.monotonic()  # Event times are seconds since the start of the session
+        self.__lock = threading.Lock()
+        self.__file = None  # Opened with the first event
+        self.__pending: dict[int, float] = {}  # { key: start time } of events which are not finished yet
+
+    """
+    Record an event, every event is one JSON line.
+    Every run of the bot appends a new session to the file, it starts with { "kind": "session", "started": unix time }
+    and the event times of the session are counted from there:
+    { "t": seconds since start, "kind": kind, "name": name, ...details }
+    kind is one of "command", "button", "select", "voice", "resolve" and "done"
+    """
+    def record(self, kind: str, name: str, **details):
+        if not self.enabled:
+            return
+
+        event = {'t': round(time.monotonic() - self.__start, 4), 'kind': kind, 'name': name, **details}
+        with self.__lock:
+            if self.__file is None:
+                log.info(f'Recording interaction trace to {self.path}')
+                self.__file = open(self.path, 'a', encoding='utf-8')
+                self.__file.write(json.dumps({'t': 0, 'kind': 'session', 'name': 'start',
+                                              'started': time.time() - (time.monotonic() - self.__start)}) + '\n')
+            self.__file.write(json.dumps(event) + '\n')
+            self.__file.flush()
+
+    # Record the event when the block finishes, with its duration (details can be added inside the block)
+    @contextmanager
+    def timed(self, kind: str, name: str, **details):
+        start = time.monotonic()
+        try:
+            yield details
+        finally:
+            self.record(kind, name, duration=round(time.monotonic() - start, 4), **details)
+
+    # Remember the start of an event which finishes in another callback (see finish)
+    def begin(self, key: int):
+        if self.enabled:
+            self.__pending[key] = time.monotonic()
+
+    # Record the end of an event started with begin
+    def finish(self, key: int, kind: str, name: str, **details):
+        start = self.__pending.pop(key, None)
+        if start is not None:
+            self.record(kind, name, duration=round(time.monotonic() - start, 4), **details)
+
+    # Read a recorded trace, its sessions are placed one after another (without the time between them)
+    @staticmethod
+    def load(path: str) -> list[dict]:
+        sessions: list[list[dict]] = [[]]
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                event = json.loads(line)
+                if event['kind'] == 'session':
+                    sessions.append([])
+                else:
+                    sessions[-1].append(event)
+
+        events = []
+        offset = 0
+        for session in sessions:
+            # Events of resolver threads may be written slightly out of order
+            session.sort(key=lambda e: e['t'])
+            for event in session:
+                event['t'] += offset
+                events.append(event)
+            if events:
+                offset = events[-1]['t']
+        return events
+
+
+recorder = TraceRecorder(TRACE_PATH)
@@ -1,10 +1,116 @@
 import pytube  # For downloading videos from YouTube
 from pytube.exceptions import RegexMatchError, AgeRestrictedError  # For YouTube error handling
 from init import log, setup_traceback
+from init import STREAM_POLICY, PREFERRED_AUDIO_CODECS  # For choosing the audio stream to download
+from init import STREAM_URL_EXPIRY_MARGIN  # For caching resolved streams
+from init import PARTIAL_DOWNLOAD_MAX_AGE  # For removing abandoned partial downloads
+from enum import Enum  # For stream policy modes
+
+import asyncio
+import threading  # For cancelling downloads running in a thread
+import time  # For stream URL expiry
+from pathlib import Path
+from typing import Any, Callable
+from urllib.error import HTTPError  # For detecting expired stream URLs
+from urllib.parse import urlparse, parse_qs  # For reading the expiry time of stream URLs
+from urllib.request import Request, urlopen  # For downloading stream chunks
 
 setup_traceback()
 
 
+# Decides which of the audio streams of a video is downloaded
+class StreamPolicy:
+    """
+    Possible modes of the policy:
+    QUALITY - the stream with the highest bitrate
+    MATCH   - the stream with the lowest bitrate that still covers the target bitrate
+              (the bitrate of the packet store, anything above it is lost when transcoding anyway)
+    ECONOMY - the stream with the lowest bitrate (smallest download, least CPU)
+    """
+    Mode = Enum('Mode', ['QUALITY', 'MATCH', 'ECONOMY'])
+
+    def __init__(self, mode: str, preferred_codecs: list[str]):
+        self.mode: StreamPolicy.Mode = StreamPolicy.Mode[mode.upper()]
+
+        # Codec prefixes in order of preference, for example ['opus', 'mp4a']
+        self.preferred_codecs = preferred_codecs
+
+    # Select the audio stream, target_bitrate is in kbps
+    def select(self, streams: list[pytube.Stream], target_bitrate: int) -> pytube.Stream | None:
+        if not streams:
+            return None
+
+        # Only keep the streams with the most preferred codec that is available
+        for codec in self.preferred_codecs:
+            candidates = [s for s in streams if s.audio_codec.startswith(codec)]
+            if candidates:
+                break
+        else:
+            candidates = streams
+
+        candidates = sorted(candidates, key=StreamPolicy.get_bitrate)
+
+        match self.mode:
+            case StreamPolicy.Mode.QUALITY:
+                return candidates[-1]
+            case StreamPolicy.Mode.ECONOMY:
+                return candidates[0]
+            case StreamPolicy.Mode.MATCH:
+                return next((s for s in candidates if StreamPolicy.get_bitrate(s) >= target_bitrate), candidates[-1])
+
+    # Get the bitrate of the stream in kbps (pytube stores it as a string, for example '160kbps')
+    @staticmethod
+    def get_bitrate(stream: pytube.Stream) -> int:
+        return int(stream.abr.removesuffix('kbps')) if stream.abr else 0
+
+
+stream_policy = StreamPolicy(STREAM_POLICY, PREFERRED_AUDIO_CODECS)
+
+
+# Keeps resolved audio streams per video, so pytube's player and signature work isn't repeated
+# The stream URLs are signed and expire, so every entry is only used until shortly before that
+class StreamCache:
+    def __init__(self, expiry_margin: float):
+        self.expiry_margin = expiry_margin  # Seconds before the URL expiry at which the entry is dropped
+
+        # { video_id: (audio streams, expiry time of the earliest expiring URL) }
+        self.__entries: dict[str, tuple[list[pytube.Stream], float]] = {}
+
+    def get(self, video_id: str) -> list[pytube.Stream] | None:
+        entry = self.__entries.get(video_id)
+        if entry is None:
+            return None
+
+        streams, expires = entry
+        if time.time() >= expires - self.expiry_margin:
+            self.invalidate(video_id)
+            return None
+        return streams
+
+    def put(self, video_id: str, streams: list[pytube.Stream]):
+        # Drop the expired entries, so the cache doesn't grow with every video ever played
+        now = time.time()
+        for vid, (_, expires) in list(self.__entries.items()):
+            if now >= expires - self.expiry_margin:
+                self.invalidate(vid)
+
+        # URLs without a known expiry are never reused
+        expires = min((StreamCache.get_expiry(s.url) for s in streams), default=0)
+        self.__entries[video_id] = (streams, expires)
+
+    def invalidate(self, video_id: str):
+        self.__entries.pop(video_id, None)
+
+    # Get the expiry time (unix timestamp) of a signed stream URL, 0 if it's unknown
+    @staticmethod
+    def get_expiry(url: str) -> float:
+        expire = parse_qs(urlparse(url).query).get('expire', ['0'])[0]
+        return float(expire) if expire.isdigit() else 0
+
+
+stream_cache = StreamCache(STREAM_URL_EXPIRY_MARGIN)
+
+
 class YoutubeObject:
     def __init__(self, query: str):
         self.error: str | None = None  # None if no error, string (the error message) if there is an error
@@ -29,14 +135,172 @@ class YoutubeObject:
             log.error(f'Query unsuccessful, {e}')
             self.error = f'Sorry, an error occurred, {e}'
 
-    def get_stream(self) -> pytube.Stream:
-        # Find the stream with only audio
+        if self.error is None:
+            self.load_details()
+
+    # pytube only queries the details when they're first used, load them now (in the caller's thread),
+    # so that displaying them in the music players doesn't block the event loop
+    def load_details(self):
+        try:
+            log.info(f'Loading video details, id={self.youtube.video_id}')
+            _ = (self.youtube.title, self.youtube.author, self.youtube.views,
+                 self.youtube.length, self.youtube.thumbnail_url)
+        except Exception as e:
+            log.error(f'Loading video details unsuccessful, {e}')
+            self.error = f'Sorry, an error occurred, {e}'
+
+    # Get the audio streams of the video (resolved once and reused until their URLs expire)
+    def get_audio_streams(self) -> list[pytube.Stream]:
+        video_id = self.youtube.video_id
+
+        streams = stream_cache.get(video_id)
+        if streams is not None:
+            log.info(f'Using cached streams, id={video_id}')
+            return streams
+
+        # Find the streams with only audio
         log.info('Filtering streams with only_audio=True')
-        stream = self.youtube.streams.filter(only_audio=True).first()
-        log.info('Filter successful')
+        streams = list(self.youtube.streams.filter(only_audio=True))
+        stream_cache.put(video_id, streams)
+        return streams
+
+    # Get the audio stream chosen by the stream policy, target_bitrate is in kbps
+    def get_stream(self, target_bitrate: int) -> pytube.Stream:
+        stream = stream_policy.select(self.get_audio_streams(), target_bitrate)
+        log.info(f'Filter successful, selected {stream.audio_codec} {stream.abr}\n\t'
+                 f'policy={stream_policy.mode.name}\n\t'
+                 f'target={target_bitrate}kbps')
+        return stream
+
+    # Resolve the stream with the given itag again, when its URL has expired or was rejected
+    def refresh_stream(self, itag: int) -> pytube.Stream:
+        log.info(f'Resolving the streams again, id={self.youtube.video_id}')
+        stream_cache.invalidate(self.youtube.video_id)
+
+        # pytube keeps the resolved streams in the YouTube object, so query the video again
+        # with a separate object (self.youtube keeps its loaded details, the music players display them)
+        streams = list(pytube.YouTube(url=self.youtube.watch_url).streams.filter(only_audio=True))
+        stream_cache.put(self.youtube.video_id, streams)
+
+        stream = next((s for s in streams if s.itag == itag), None)
+        if stream is None:
+            raise RuntimeError(f'Stream itag={itag} is not available anymore')
         return stream
 
 
+# Raised in the download thread when the download was cancelled
+class DownloadCancelled(Exception):
+    pass
+
+
+# Download of an audio stream which can be cancelled at any moment (pytube's Stream.download can't be)
+class Download:
+    chunk_size: int = 1024 * 1024  # Bytes requested at once (YouTube throttles large single requests)
+    block_size: int = 64 * 1024  # Bytes read between checks for cancellation
+    timeout: float = 30  # Seconds a stalled connection is waited for before the download fails
+    part_max_age: float = PARTIAL_DOWNLOAD_MAX_AGE  # Partial downloads untouched for this long are removed
+
+    # { path: lock } - only one download (thread) at a time may write the partial file of a path
+    __path_locks: dict[Path, threading.Lock] = {}
+    __path_locks_lock = threading.Lock()
+
+    def __init__(self, stream: pytube.Stream, path: Path, keep_partial: bool,
+                 refresh: Callable[[], pytube.Stream] | None = None):
+        self.stream = stream
+        self.path = path
+        self.part_path = path.with_name(path.name + '.part')  # Not finished download
+
+        # If True, the partial file of a cancelled download is kept and the next download of it resumes from there
+        self.keep_partial = keep_partial
+
+        # Resolves the same stream again if its URL is rejected (for example, it has expired)
+        self.refresh = refresh
+        self.__refreshed: bool = False  # The stream is refreshed at most once per download
+
+        self.__cancelled = threading.Event()
+
+    # Download the stream without blocking the event loop, cancelling the awaiting task cancels the download
+    async def run(self) -> Path:
+        try:
+            return await asyncio.to_thread(self.__download)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+    def cancel(self):
+        self.__cancelled.set()
+
+    def __download(self) -> Path:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        Download.__remove_stale_parts(self.path.parent)
+
+        with Download.__path_locks_lock:
+            lock = Download.__path_locks.setdefault(self.path, threading.Lock())
+
+        # A cancelled download of the same file may still be finishing its last read, wait for it
+        while not lock.acquire(timeout=0.1):
+            if self.__cancelled.is_set():
+                raise DownloadCancelled()
+
+        try:
+            return self.__download_locked()
+        finally:
+            lock.release()
+
+    def __download_locked(self) -> Path:
+        downloaded = self.part_path.stat().st_size if self.part_path.exists() else 0
+        size = self.__fetch(lambda stream: stream.filesize)
+        if downloaded:
+            log.info(f'Resuming the download of {self.path.name} from {downloaded}/{size} bytes')
+
+        try:
+            with open(self.part_path, 'ab') as file:
+                while downloaded < size:
+                    stop = min(downloaded + Download.chunk_size, size) - 1
+                    with self.__fetch(lambda stream: urlopen(Request(
+                            f'{stream.url}&range={downloaded}-{stop}',
+                            headers={'User-Agent': 'Mozilla/5.0', 'accept-language': 'en-US,en'}),
+                            timeout=Download.timeout)) as response:
+                        while block := response.read(Download.block_size):
+                            if self.__cancelled.is_set():
+                                raise DownloadCancelled()
+                            file.write(block)
+                            downloaded += len(block)
+
+        except DownloadCancelled:
+            log.info(f'Download of {self.path.name} cancelled at {downloaded}/{size} bytes')
+            if not self.keep_partial:
+                self.part_path.unlink(missing_ok=True)
+            raise
+
+        self.part_path.replace(self.path)
+        return self.path
+
+    # Remove partial downloads nobody has resumed for part_max_age seconds
+    @staticmethod
+    def __remove_stale_parts(directory: Path):
+        deadline = time.time() - Download.part_max_age
+        for part_path in directory.glob('*.part'):
+            try:
+                if part_path.stat().st_mtime < deadline:
+                    part_path.unlink()
+                    log.info(f'Removed stale partial download {part_path.name}')
+            except (FileNotFoundError, PermissionError):  # Removed by another download, or still open
+                pass
+
+    # Call fetch with the stream, if the stream URL is rejected, refresh the stream and try again
+    def __fetch(self, fetch: Callable[[pytube.Stream], Any]):
+        try:
+            return fetch(self.stream)
+        except HTTPError as e:
+            if e.code != 403 or self.refresh is None or self.__refreshed:
+                raise
+            log.warn(f'Stream URL rejected with {e.code}, refreshing the stream')
+            self.stream = self.refresh()
+            self.__refreshed = True
+            return fetch(self.stream)
+
+
 class Search:
     # Get list of video urls by search term
     @staticmethod